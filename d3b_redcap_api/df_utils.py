@@ -1,3 +1,4 @@
+import re
 from collections import Counter
 
 from numpy import nan
@@ -11,23 +12,44 @@ def to_df(records_tree, event_name, instrument_name):
     # get instrument records
     records = records_tree[event_name][instrument_name]
 
-    # build dataframe rows from records
-    acc = []
+    # build dataframe columns from records, in order of first appearance
+    instance_col = f"subject_{instrument_name}_instance"
+    fields = dict.fromkeys(
+        k for entries in records.values() for e in entries.values() for k in e
+    )
+    cols = {"subject": [], instance_col: [], **{k: [] for k in fields}}
+
+    # the same selections recur across many subjects, so join each distinct
+    # value set only once
+    joined = {}
+
+    def _join(v):
+        if len(v) == 1:  # most cells hold one value, so nothing to join
+            (j,) = v
+            return j
+        fs = frozenset(v)
+        j = joined.get(fs)
+        if j is None:
+            j = joined[fs] = "+".join(sorted(fs))
+        return j
+
     for s, entries in records.items():
         for i, e in entries.items():
-            entry = {"subject": s, f"subject_{instrument_name}_instance": i}
-            entry.update({k: "+".join(sorted(v)) for k, v in e.items()})
-            acc.append(entry)
-    df = DataFrame(acc)
+            cols["subject"].append(s)
+            cols[instance_col].append(i)
+            for k in fields:
+                v = e.get(k)
+                cols[k].append(nan if v is None else _join(v))
+    df = DataFrame(cols, copy=False)
 
     # drop rows that are empty in important (not unimportant) fields
     unimportant = {
         "subject",
-        f"subject_{instrument_name}_instance",
+        instance_col,
         f"{instrument_name}_complete",
     }
-    df = df.dropna(how="all", subset=df.columns.difference(unimportant))
-    return df
+    important = [c for c in df.columns if c not in unimportant]
+    return df.loc[df[important].notna().to_numpy().any(axis=1)]
 
 
 def all_dfs(records_tree):
@@ -51,5 +73,7 @@ def summary_column(df, from_col_names, separator):
     """
     Create a delimited summary column from multiple columns.
     """
-    nc = df[from_col_names].apply(lambda r: separator.join(r), axis=1)
-    return nc.replace(f"^{separator}{separator}$", "", regex=True)
+    first, *rest = from_col_names
+    nc = df[first].str.cat([df[c] for c in rest], sep=separator, na_rep="")
+    sep = re.escape(separator)
+    return nc.replace(re.compile(f"^{sep}{sep}$"), "", regex=True)
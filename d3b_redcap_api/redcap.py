@@ -1,15 +1,51 @@
+import gzip
+import hashlib
 import json
+import os
 import re
-from collections import defaultdict
-from urllib.parse import unquote
+import tempfile
+import time
+import zlib
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain
+from sys import intern
+from urllib.parse import unquote_to_bytes
 
 from d3b_utils.requests_retry import Session
 
+# orjson is optional but parses large record exports several times faster
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj):
+        # accept what the standard json module does, like numpy floats from
+        # DataFrame cells and non-str keys, so orjson is purely a speedup
+        try:
+            return orjson.dumps(
+                obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+            ).decode()
+        except TypeError:
+            return json.dumps(obj)
+
+except ImportError:
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+# file name in the Content-Type header of a file export
+_FILE_NAME_RE = re.compile(r'name="([^"]*)"')
+
 
 def _undefault_dict(d):
+    # converts in place instead of rebuilding every node
+    if isinstance(d, defaultdict):
+        d.default_factory = None
     if isinstance(d, dict):
-        d = {k: _undefault_dict(v) for k, v in d.items()}
-    if isinstance(d, set):
+        for k, v in d.items():
+            d[k] = _undefault_dict(v)
+    elif isinstance(d, set):
         return sorted(d)
     return d
 
@@ -18,6 +54,84 @@ class REDCapError(Exception):
     pass
 
 
+def _run_batches(func, batches, workers):
+    """Call func on each batch of subjects in a pool of workers, with at most
+    `workers` batches in flight at once.
+
+    The server tends to refuse requests for too many subjects with an HTTP 500
+    or 400, so a batch that fails that way is split in half and both halves
+    are queued again. A 400 that comes back for both halves of a batch is
+    about the request itself rather than its size, so it is raised instead of
+    splitting any further.
+
+    :return: generator of func's results in the order the batches finish.
+        The first requests are sent right away, and later ones only as the
+        generator is advanced.
+    :raises REDCapError: from the generator, once a batch fails for good.
+        By then every other batch has been cancelled or has finished.
+    """
+    queue = deque((batch, None) for batch in batches)
+    ex = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+
+    def _submit():
+        while queue and len(pending) < workers:
+            batch, split = queue.popleft()
+            pending[ex.submit(func, batch)] = (batch, split)
+
+    def _results():
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch, split = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except REDCapError as e:
+                        error = str(e)
+                        # split holds the 400 that this batch's parent got and
+                        # how many of the parent's halves failed the same way
+                        if split is not None and error == split["error"]:
+                            split["failed"] += 1
+                        if (
+                            len(batch) < 2
+                            or not error.startswith(("HTTP 400", "HTTP 500"))
+                            or (split is not None and split["failed"] > 1)
+                        ):
+                            # don't leave requests running behind the caller
+                            for f in pending:
+                                f.cancel()
+                            ex.shutdown(wait=True)
+                            raise
+                        print("Reducing batch size and trying again...")
+                        half = (len(batch) + 1) // 2
+                        halves_split = None
+                        if error.startswith("HTTP 400"):
+                            halves_split = {"error": error, "failed": 0}
+                        queue.appendleft((batch[half:], halves_split))
+                        queue.appendleft((batch[:half], halves_split))
+                        continue
+                    yield result
+                _submit()
+        finally:
+            for f in pending:
+                f.cancel()
+            ex.shutdown(wait=False)
+
+    _submit()
+    return _results()
+
+
+# API content types that are cached by REDCapStudy._get_cached
+_CACHED_CONTENT = (
+    "metadata",
+    "formEventMapping",
+    "exportFieldNames",
+    "project",
+    "version",
+)
+
+
 # Note to future developers: This class uses get_ and set_ methods on purpose
 # to control the user experience. Please don't replace them with property
 # decorators. It needs to be completely unambiguous without inspecting the
@@ -26,9 +140,55 @@ class REDCapError(Exception):
 # project administrative privilege, not just some data container.
 # - Avi
 class REDCapStudy:
-    def __init__(self, api_url, api_token):
+    def __init__(
+        self,
+        api_url,
+        api_token,
+        cache_dir=None,
+        cache_max_age=24 * 60 * 60,
+    ):
+        """
+        :param api_url: URL of the REDCap server's API endpoint
+        :param api_token: API token for the project
+        :param cache_dir: if given, also cache project metadata in this
+            directory so that it survives between processes (defaults to the
+            REDCAP_CACHE environment variable, otherwise no disk cache)
+        :param cache_max_age: seconds before disk-cached metadata is fetched
+            from the server again
+        """
         self.api = api_url
         self.api_token = api_token
+        # API content that rarely changes, keyed by content type
+        self._cache = {}
+        cache_dir = cache_dir or os.environ.get("REDCAP_CACHE")
+        self._cache_dir = cache_dir and os.path.expanduser(cache_dir)
+        self._cache_max_age = cache_max_age
+        self._metadata_indices = None
+        # one session for the life of the study so that connections to the
+        # server are kept alive and reused between requests
+        self._session = Session(status_forcelist=(502, 503, 504))
+
+    def close(self):
+        """Release the pooled connections to the server"""
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def refresh_metadata(self):
+        """Forget cached project metadata so that the next request for it goes
+        to the server again."""
+        self._cache.clear()
+        self._metadata_indices = None
+        if self._cache_dir:
+            for content in _CACHED_CONTENT:
+                try:
+                    os.remove(self._disk_cache_path(content))
+                except FileNotFoundError:
+                    pass
 
     def _get_response(self, content, params=None, **kwargs):
         """API request implementation
@@ -44,23 +204,73 @@ class REDCapStudy:
             "format": "json",
             "returnFormat": "json",
         }
-        all_params.update(params or {})
-        if "data" in all_params and not isinstance(all_params["data"], str):
-            all_params["data"] = json.dumps(all_params["data"])
-        all_params = {k: v for k, v in all_params.items() if v is not None}
-        resp = Session(status_forcelist=(502, 503, 504)).post(
-            self.api, data=all_params, **kwargs
-        )
+        for k, v in (params or {}).items():
+            if k == "data" and not isinstance(v, str):
+                all_params[k] = _json_dumps(v)
+            elif v is None:
+                all_params.pop(k, None)
+            else:
+                all_params[k] = v
+        resp = self._session.post(self.api, data=all_params, **kwargs)
         if resp.status_code != 200:
             raise REDCapError(f"HTTP {resp.status_code} - {resp.text}")
         return resp
 
     def _get_json(self, *args, **kwargs):
-        return self._get_response(*args, **kwargs).json()
+        return _json_loads(self._get_response(*args, **kwargs).content)
 
     def _get_text(self, *args, **kwargs):
         return self._get_response(*args, **kwargs).text
 
+    def _get_cached(self, content, getter):
+        """Fetch content with getter unless it's already in the cache.
+
+        Cached results are shared between callers, so treat them as read-only.
+        """
+        if content not in self._cache:
+            if self._cache_dir:
+                self._cache[content] = self._get_disk_cached(content, getter)
+            else:
+                self._cache[content] = getter(content)
+        return self._cache[content]
+
+    def _disk_cache_path(self, content):
+        # don't write the token itself anywhere
+        token_hash = hashlib.sha1(self.api_token.encode()).hexdigest()
+        key = f"{self.api}|{token_hash}|{content}"
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self._cache_dir, f"{name}.json.gz")
+
+    def _get_disk_cached(self, content, getter):
+        """Like _get_cached, but backed by a gzipped JSON file per content
+        type that is refreshed once it's older than cache_max_age."""
+        path = self._disk_cache_path(content)
+        try:
+            if time.time() - os.path.getmtime(path) < self._cache_max_age:
+                with open(path, "rb") as f:
+                    return _json_loads(gzip.decompress(f.read()))
+        except (OSError, EOFError, ValueError, zlib.error):
+            pass  # missing or unreadable, so just fetch it again
+
+        value = getter(content)
+        tmp_path = None
+        try:
+            # write to a temporary file first so that readers never see a
+            # partially written cache file
+            os.makedirs(self._cache_dir, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(gzip.compress(_json_dumps(value).encode()))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not cache {content} in {self._cache_dir}: {e}")
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+        return value
+
     def get_arm_names(self):
         """Export Arm names
 
@@ -76,14 +286,18 @@ class REDCapStudy:
         :return: number of Arms imported
         """
         # https://redcap.chop.edu/api/help/?content=imp_arms
-        return self._get_json(
-            "arm",
-            params={
-                "data": arms,
-                "override": "1" if delete_all_first else "0",
-                "action": "import",
-            },
-        )
+        try:
+            return self._get_json(
+                "arm",
+                params={
+                    "data": arms,
+                    "override": "1" if delete_all_first else "0",
+                    "action": "import",
+                },
+            )
+        finally:
+            # replacing arms also drops their events and instrument mappings
+            self.refresh_metadata()
 
     def get_event_metadata(self):
         """Export Event details (names, numbers, labels, offsets)
@@ -101,13 +315,17 @@ class REDCapStudy:
         :return: number of Events imported
         """
         # https://redcap.chop.edu/api/help/?content=imp_metadata
-        return self._get_json(
-            "event",
-            params={
-                "action": "import",
-                "override": "1" if delete_all_first else "0",
-            },
-        )
+        try:
+            return self._get_json(
+                "event",
+                params={
+                    "action": "import",
+                    "override": "1" if delete_all_first else "0",
+                },
+            )
+        finally:
+            # replacing events also drops their instrument mappings
+            self.refresh_metadata()
 
     def get_instrument_labels(self):
         """Export mappings of instrument internal names to their display labels
@@ -119,10 +337,13 @@ class REDCapStudy:
     def get_field_export_names(self):
         """Export mappings of field names and selected values to exported names
 
+        The result is derived from the data dictionary, so it is cached along
+        with it. Treat it as read-only.
+
         :return: list of dicts of field choices
         """
         # https://redcap.chop.edu/api/help/?content=exp_field_names
-        return self._get_json("exportFieldNames")
+        return self._get_cached("exportFieldNames", self._get_json)
 
     def _act_file(
         self,
@@ -132,6 +353,7 @@ class REDCapStudy:
         event=None,
         repeat_instance=None,
         file_data=None,
+        **kwargs,
     ):
         params = {
             "action": action,
@@ -140,27 +362,35 @@ class REDCapStudy:
             "event": event,
             "repeat_instance": repeat_instance,
         }
-        return self._get_response("file", params, files=file_data)
+        return self._get_response("file", params, files=file_data, **kwargs)
 
-    def get_file(self, record, field, event=None, repeat_instance=None):
+    def get_file(
+        self, record, field, event=None, repeat_instance=None, stream=False
+    ):
         """Export a File from a file upload field on a record
 
         :param record: the record ID the file is attached to
         :param field: the name of field with the file
         :param event: event name if longitudinal
         :param repeat_instance: which instance if instrument/event is repeating
-        :return: dict with "filename" str and "body" bytes
+        :param stream: download the body in chunks as it is iterated instead
+            of all at once, so that large files don't have to fit in memory
+        :return: dict with "filename" str and "body" bytes (or an iterator of
+            bytes chunks if stream is True)
         """
         # https://redcap.chop.edu/api/help/?content=exp_file
-        resp = self._act_file("export", record, field, event, repeat_instance)
-        file_name = (
-            unquote(
-                resp.headers["Content-Type"].split('name="')[1].split('";')[0]
-            )
-            .encode("latin1")
-            .decode("utf-8")
+        resp = self._act_file(
+            "export", record, field, event, repeat_instance, stream=stream
         )
-        return {"body": resp.content, "filename": file_name}
+        # headers arrive decoded as latin-1, so recover the raw bytes and
+        # percent-decode those before decoding the name as UTF-8
+        file_name = _FILE_NAME_RE.search(resp.headers["Content-Type"])[1]
+        file_name = unquote_to_bytes(file_name.encode("latin1")).decode("utf-8")
+        if stream:
+            body = resp.iter_content(chunk_size=64 * 1024)
+        else:
+            body = resp.content
+        return {"body": body, "filename": file_name}
 
     def set_file(
         self,
@@ -210,18 +440,23 @@ class REDCapStudy:
     def get_redcap_version(self):
         """Get the version of REDCap as a string"""
         # https://redcap.chop.edu/api/help/?content=exp_rc_v
-        return self._get_text("version")
+        return self._get_cached("version", self._get_text)
 
     def get_project_info(self):
         """Get basic project attributes such as title, logitudinality,
         if surveys are enabled, creation time, etc."""
-        return self._get_json("project")
+        return self._get_cached("project", self._get_json)
 
     def set_project_info(self, project_info):
         """Set basic project attributes such as title, logitudinality,
         if surveys are enabled, creation time, etc."""
         # https://redcap.chop.edu/api/help/?content=imp_proj_sett
-        return self._get_json("project_settings", params={"data": project_info})
+        try:
+            return self._get_json(
+                "project_settings", params={"data": project_info}
+            )
+        finally:
+            self.refresh_metadata()
 
     def get_project_xml(
         self,
@@ -242,7 +477,53 @@ class REDCapStudy:
 
         :return: string contents of an XML file
         """
-        return self._get_text(
+        return self._get_project_xml_response(
+            metadata_only,
+            include_data_access_groups,
+            include_survey_fields,
+            include_files,
+        ).text
+
+    def get_project_xml_to_file(
+        self,
+        path,
+        metadata_only=True,
+        include_data_access_groups=True,
+        include_survey_fields=True,
+        include_files=True,
+    ):
+        """Like get_project_xml, but write the XML straight to a file as it
+        downloads instead of holding all of it in memory as a string.
+
+        :param path: where to write the XML file
+        (see get_project_xml for the other parameters)
+        """
+        resp = self._get_project_xml_response(
+            metadata_only,
+            include_data_access_groups,
+            include_survey_fields,
+            include_files,
+            stream=True,
+        )
+        with resp, open(path, "wb") as f:
+            try:
+                for chunk in resp.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+            except BaseException:
+                # don't leave a truncated file that looks like a full export
+                f.close()
+                os.remove(path)
+                raise
+
+    def _get_project_xml_response(
+        self,
+        metadata_only,
+        include_data_access_groups,
+        include_survey_fields,
+        include_files,
+        **kwargs,
+    ):
+        return self._get_response(
             "project_xml",
             {
                 "returnMetadataOnly": metadata_only,
@@ -250,6 +531,7 @@ class REDCapStudy:
                 "exportSurveyFields": include_survey_fields,
                 "exportFiles": include_files,
             },
+            **kwargs,
         )
 
     def get_users(self):
@@ -265,8 +547,12 @@ class REDCapStudy:
         return self._get_json("user", {"data": users})
 
     def get_data_dictionary(self):
-        """Get the instrument definition information."""
-        return self._get_json("metadata")
+        """Get the instrument definition information.
+
+        The result is cached on this object and shared between callers, so
+        treat it as read-only. Use refresh_metadata to fetch it again.
+        """
+        return self._get_cached("metadata", self._get_json)
 
     def set_data_dictionary(self, data_dictionary):
         """Set the instrument definitions.
@@ -274,13 +560,30 @@ class REDCapStudy:
         :param data_dictionary: see output of get_data_dictionary
         :return: number of fields imported
         """
-        return self._get_json("metadata", {"data": data_dictionary})
+        try:
+            return self._get_json("metadata", {"data": data_dictionary})
+        finally:
+            self.refresh_metadata()
 
     def get_instrument_event_mappings(self):
-        return self._get_json("formEventMapping")
+        return self._get_cached("formEventMapping", self._get_json)
 
     def set_instrument_event_mappings(self, iem):
-        return self._get_json("formEventMapping", {"data": iem})
+        try:
+            return self._get_json("formEventMapping", {"data": iem})
+        finally:
+            self.refresh_metadata()
+
+    def _fetch_schema(self):
+        """Get the data dictionary and the instrument-event mappings together,
+        requesting both at once when neither is cached yet.
+
+        :return: (data dictionary, instrument-event mappings)
+        """
+        with ThreadPoolExecutor(max_workers=1) as background:
+            iems = background.submit(self.get_instrument_event_mappings)
+            data_dict = self.get_data_dictionary()
+        return data_dict, iems.result()
 
     def create_project(self, project_data):
         raise NotImplementedError()  # TODO
@@ -301,13 +604,20 @@ class REDCapStudy:
         store = defaultdict(  # forms
             lambda: defaultdict(dict)  # events and fields
         )
-        for m in self.get_data_dictionary():
-            instrument = m.pop("form_name")
-            field_name = m.pop("field_name")
-            store[instrument]["fields"][field_name] = m
+        data_dict, iems = self._fetch_schema()
+
+        for m in data_dict:
+            # don't pop from m, the data dictionary is cached and shared
+            instrument = m["form_name"]
+            field_name = m["field_name"]
+            store[instrument]["fields"][field_name] = {
+                k: v
+                for k, v in m.items()
+                if k not in {"form_name", "field_name"}
+            }
             store[instrument]["events"] = set()
 
-        for form in self.get_instrument_event_mappings():
+        for form in iems:
             store[form["form"]]["events"].add(form["unique_event_name"])
 
         return _undefault_dict(store)
@@ -334,6 +644,61 @@ class REDCapStudy:
         id_records = self._records_getter("record", params={"fields": id_field})
         return list({e[id_field] for e in id_records})
 
+    def _get_record_batches(
+        self,
+        type,
+        raw,
+        raw_headers,
+        checkbox_labels,
+        survey_fields,
+        data_access_groups,
+        fields,
+        batch_size=None,
+        workers=4,
+    ):
+        """Starts downloading all records in concurrent batches of subjects.
+
+        :return: generator of record lists, one per batch, in the order the
+            batches finish downloading (see _run_batches)
+        :raises REDCapError: from the generator, if a batch fails for a
+            reason other than being too large
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if batch_size is not None and batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        subjects = self.get_subjects()
+        print(f"Found {len(subjects)} subjects.")
+        params = {
+            "type": type,
+            "exportSurveyFields": "true" if survey_fields else "false",
+            "exportDataAccessGroups": (
+                "true" if data_access_groups else "false"
+            ),
+        }
+        # REDCap accepts comma-delimited lists in place of arrays, which
+        # keeps the request body from repeating "records[i]=" per subject
+        if fields:
+            params["fields"] = ",".join(fields)
+
+        def _fetch(batch):
+            print(f"Requesting {len(batch)} subjects...")
+            return self._records_getter(
+                "record",
+                raw=raw,
+                raw_headers=raw_headers,
+                checkbox_labels=checkbox_labels,
+                params={**params, "records": ",".join(batch)},
+            )
+
+        if batch_size is None:
+            batch_size = max(1, -(-len(subjects) // workers))
+        batches = [
+            subjects[i : i + batch_size]
+            for i in range(0, len(subjects), batch_size)
+        ]
+        return _run_batches(_fetch, batches, workers)
+
     def get_records(
         self,
         type="eav",
@@ -343,47 +708,31 @@ class REDCapStudy:
         survey_fields=True,
         data_access_groups=True,
         fields=None,
+        batch_size=None,
+        workers=4,
     ):
-        """Returns all data from the study without restructuring"""
-        remaining_subjects = self.get_subjects()
-        batch_size = len(remaining_subjects)
-        print(f"Found {batch_size} subjects.")
-        records = []
-        while remaining_subjects:
-            batch = remaining_subjects[:batch_size]
-            print(f"Requesting {len(batch)} subjects...")
-            params = {
-                "type": type,
-                "exportSurveyFields": "true" if survey_fields else "false",
-                "exportDataAccessGroups": "true"
-                if data_access_groups
-                else "false",
-            }
-            for i, r in enumerate(batch):
-                params[f"records[{i}]"] = r
-
-            if fields:
-                for i, f in enumerate(fields):
-                    params[f"fields[{i}]"] = f
+        """Returns all data from the study without restructuring
 
-            try:
-                records.extend(
-                    self._records_getter(
-                        "record",
-                        raw=raw,
-                        raw_headers=raw_headers,
-                        checkbox_labels=checkbox_labels,
-                        params=params,
-                    )
-                )
-                remaining_subjects = remaining_subjects[batch_size:]
-            except REDCapError as e:
-                if str(e).startswith(("HTTP 400", "HTTP 500")):
-                    print("Reducing batch size and trying again...")
-                    batch_size = int(0.5 + (batch_size / 2))
-                else:
-                    print(str(e))
-                    return
+        :param batch_size: how many subjects to request at a time, by default
+            the subjects are split evenly between the workers
+        :param workers: how many batches to request at once
+        """
+        batches = self._get_record_batches(
+            type=type,
+            raw=raw,
+            raw_headers=raw_headers,
+            checkbox_labels=checkbox_labels,
+            survey_fields=survey_fields,
+            data_access_groups=data_access_groups,
+            fields=fields,
+            batch_size=batch_size,
+            workers=workers,
+        )
+        try:
+            records = [r for batch in batches for r in batch]
+        except REDCapError as e:
+            print(str(e))
+            return
 
         if type == "eav":
             id_field = self.get_data_dictionary()[0]["field_name"]
@@ -403,6 +752,50 @@ class REDCapStudy:
             args["returnContent"] = "auto_ids"
         return self._get_json("record", params=args)
 
+    def set_records_batched(
+        self, records, type="eav", overwrite=False, batch_size=500, workers=4
+    ):
+        """Like set_records, but import the records in concurrent batches of
+        subjects, because large imports sent all at once tend to time out.
+
+        A subject's records are never split between batches. Any batch that
+        the server rejects as too large is split in half and both halves are
+        sent again. If a batch fails for good, its error is raised once the
+        other imports in flight have finished, and batches that were already
+        imported stay imported.
+
+        :param batch_size: how many subjects to import at a time
+        :param workers: how many batches to import at once
+        :raises REDCapError: a batch failed to import
+        :return: {"count": <number of records imported>}
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        if type == "eav":
+            id_field = "record"
+        else:
+            id_field = self.get_data_dictionary()[0]["field_name"]
+        by_subject = defaultdict(list)
+        for r in records:
+            by_subject[r[id_field]].append(r)
+        subjects = list(by_subject.values())
+
+        def _import(batch):
+            return self.set_records(
+                [r for s in batch for r in s], type, overwrite
+            )
+
+        batches = [
+            subjects[i : i + batch_size]
+            for i in range(0, len(subjects), batch_size)
+        ]
+        count = 0
+        for result in _run_batches(_import, batches, workers):
+            count += result["count"]
+        return {"count": count}
+
     def delete_records(self, record_name_list, arm=None):
         args = {"action": "delete"}
         for i, r in enumerate(record_name_list):
@@ -428,6 +821,50 @@ class REDCapStudy:
             params={"report_id": report_id},
         )
 
+    def _get_metadata_indices(self):
+        """Digest the data dictionary in a single pass into a map of field name
+        to instrument name (including the "<instrument>_complete" fields) and
+        the selector choice map. Cached until refresh_metadata is called.
+
+        :return: tuple of (field_forms, selector_map)
+        """
+        if self._metadata_indices is not None:
+            return self._metadata_indices
+
+        # the fixed choice sets are the same for every field that uses them,
+        # so build each once and share it between those fields
+        yes_no = {"1": "Yes", "0": "No"}
+        true_false = {"1": "True", "0": "False"}
+        complete = {"2": "Complete", "1": "Unverified", "0": "Incomplete"}
+
+        field_forms = dict()
+        selector_map = dict()
+        for m in self.get_data_dictionary():
+            field_forms[m["field_name"]] = m["form_name"]
+            field_type = m["field_type"]
+            if field_type == "yesno":
+                selector_map[m["field_name"]] = yes_no
+            elif field_type == "truefalse":
+                selector_map[m["field_name"]] = true_false
+            elif field_type in {"dropdown", "radio", "checkbox"}:
+                choices = m.get("select_choices_or_calculations")
+                if choices:  # an empty string would give a bogus {"": ""}
+                    selector_map[m["field_name"]] = {
+                        k.strip(): v.strip()
+                        for k, _, v in (
+                            c.partition(",") for c in choices.split("|")
+                        )
+                    }
+
+        # "<instrument>_complete" fields are not considered part of the
+        # instruments, so include them specially
+        for f in set(field_forms.values()):
+            field_forms[f"{f}_complete"] = f
+            selector_map[f"{f}_complete"] = complete
+
+        self._metadata_indices = (field_forms, selector_map)
+        return self._metadata_indices
+
     def get_selector_choice_map(self):
         """Returns a map for every field that needs translation from index to
         value:
@@ -438,33 +875,15 @@ class REDCapStudy:
             },
             ...
         }
+
+        Like the data dictionary it's built from, the result is cached on this
+        object until refresh_metadata is called, so treat it as read-only.
         """
-        store = dict()
-        forms = set()
-        for m in self.get_data_dictionary():
-            forms.add(m["form_name"])
-            if m["field_type"] in {"dropdown", "radio", "checkbox"}:
-                store[m["field_name"]] = {
-                    k.strip(): v.strip()
-                    for k, v in map(
-                        lambda x: x.split(",", 1),
-                        m["select_choices_or_calculations"].split("|"),
-                    )
-                }
-            elif m["field_type"] == "yesno":
-                store[m["field_name"]] = {"1": "Yes", "0": "No"}
-            elif m["field_type"] == "truefalse":
-                store[m["field_name"]] = {"1": "True", "0": "False"}
-
-        for f in forms:
-            store[f + "_complete"] = {
-                "2": "Complete",
-                "1": "Unverified",
-                "0": "Incomplete",
-            }
-        return store
+        return self._get_metadata_indices()[1]
 
-    def get_records_tree(self, debug_type="flat", raw_selectors=False):
+    def get_records_tree(
+        self, debug_type="flat", raw_selectors=False, batch_size=None, workers=4
+    ):
         """Returns all data from the study in the nested form:
         {
             <event_name>: {            # event data
@@ -482,32 +901,55 @@ class REDCapStudy:
             },
             ...
         }
+
+        :param batch_size: how many subjects to request at a time, by default
+            the subjects are split evenly between the workers. Set it to
+            bound memory use on large projects: at most `workers` batches of
+            records are downloaded and held at once.
+        :param workers: how many batches to request at once
         """
-        # this is where we'll store all the data
-        store = defaultdict(  # events
-            lambda: defaultdict(  # instruments
-                lambda: defaultdict(  # subjects
-                    lambda: defaultdict(  # instances
-                        lambda: defaultdict(set)  # field names  # values
-                    )
-                )
-            )
+        # this is where we'll collect all the data, keyed flat by
+        # (event, instrument, subject, instance, field) -> set of values
+        # and only nested into the returned tree at the very end
+        acc = {}
+
+        # Download the instrument-event mappings alongside the data dictionary,
+        # then start the records in the background while the metadata is
+        # digested. The records need the data dictionary to find subjects, so
+        # fetch that first to avoid requesting it twice. The mappings are
+        # checked before any records are requested because projects that
+        # don't have them (e.g. classic projects) fail right here.
+        # Record batches are folded into the store as they arrive, so the
+        # export is never concatenated into one list, and the next batch is
+        # only requested once one has been taken. That bounds the records held
+        # at once to `workers` batches, which with the default batch_size is
+        # still the whole export.
+        background = ThreadPoolExecutor(max_workers=1)
+        iems = background.submit(self.get_instrument_event_mappings)
+        data_dict = self.get_data_dictionary()
+        event_mappings = iems.result()
+        record_batches = background.submit(
+            self._get_record_batches,
+            type=debug_type,
+            raw=True,
+            raw_headers=True,
+            checkbox_labels=False,
+            survey_fields=True,
+            data_access_groups=True,
+            fields=None,
+            batch_size=batch_size,
+            workers=workers,
         )
+        background.shutdown(wait=False)
 
-        data_dict = self.get_data_dictionary()
         record_id_field = data_dict[0]["field_name"]
-        field_forms = {m["field_name"]: m["form_name"] for m in data_dict}
-        # "<instrument>_complete" fields are not considered part of the
-        # instruments, so include them specially
-        for inst in set(field_forms.values()):
-            field_forms[f"{inst}_complete"] = inst
+        field_forms, selector_map = self._get_metadata_indices()
+        complete_forms = {f"{f}_complete": f for f in set(field_forms.values())}
 
         event_forms = defaultdict(set)
-        for iem in self.get_instrument_event_mappings():
+        for iem in event_mappings:
             event_forms[iem["unique_event_name"]].add(iem["form"])
 
-        selector_map = self.get_selector_choice_map()
-
         # We could retrieve labels instead of raw, but two different
         # instruments could be given the same name which are meant to be
         # interpreted based on context. That may mean that we couldn't
@@ -524,19 +966,43 @@ class REDCapStudy:
         # come from instruments that aren't repeating. Maybe that will change,
         # but this code would probably keep working anyway. - Nov 2019
 
+        # flat records all share one set of columns, so work out which of them
+        # are fields once instead of popping the bookkeeping keys off each row
+        not_fields = {
+            "redcap_event_name",
+            "redcap_repeat_instance",
+            "redcap_repeat_instrument",
+            record_id_field,
+        }
+        flat_fields = []
+        flat_len = None
+
         errors = defaultdict(list)
-        all_subjects = set()
-        for r in self.get_records(
-            type=debug_type,
-            raw=True,
-            raw_headers=True,
-            checkbox_labels=False,
-            survey_fields=True,
-            data_access_groups=True,
+        choice_map = {} if raw_selectors else selector_map
+
+        # bound lookups for the hot loops below
+        get_choices = choice_map.get
+        get_form = field_forms.get
+        get_complete_form = complete_forms.get
+        get_event_forms = event_forms.get
+        get_values = acc.get
+
+        # Defined once rather than per record, with everything that varies
+        # per value passed in explicitly.
+        def _check_error_map_add(
+            event, event_form_names, subject, instance, form, field, value
         ):
-
-            def _check_error_map_add():
-                def _record_error(what):
+            mapped_value = value
+            choices = get_choices(field)
+            if choices is not None:
+                mapped_value = choices.get(value)
+                if mapped_value is None:
+                    # Is this code the right place for data error checks?
+                    # Consider removing this.
+                    if value in choices.values():
+                        what = "choice value as text"
+                    else:
+                        what = "choice value is missing"
                     errors[what].append(
                         {
                             "event": event,
@@ -546,61 +1012,76 @@ class REDCapStudy:
                             "form": form,
                         }
                     )
-
-                mapped_value = value
-                if (not raw_selectors) and (field in selector_map):
-                    if value not in selector_map[field]:
-                        # Is this code the right place for data error checks?
-                        # Consider removing this.
-                        if value in selector_map[field].values():
-                            _record_error("choice value as text")
-                        else:
-                            _record_error("choice value is missing")
-                        return False
-                    mapped_value = selector_map[field][value]
-                if field not in field_forms:
-                    return False
-                if event not in event_forms:
                     return False
-                if form not in event_forms[event]:
-                    return False
-                if field != record_id_field:
-                    if field == f"{form}_complete":
-                        store[event][form][subject][instance][field] = {
-                            mapped_value
-                        }
-                    else:
-                        store[event][form][subject][instance][field].add(
-                            mapped_value
-                        )
-                return True
+            if field not in field_forms:
+                return False
+            if event_form_names is None:
+                return False
+            if form not in event_form_names:
+                return False
+            if field != record_id_field:
+                key = (event, form, subject, instance, field)
+                values = get_values(key)
+                if values is None or get_complete_form(field) == form:
+                    acc[key] = {mapped_value}
+                else:
+                    values.add(mapped_value)
+            return True
 
-            event = r.pop("redcap_event_name")
+        all_subjects = set()
+        add_subject = all_subjects.add
+        for r in chain.from_iterable(record_batches.result()):
+            # Event, instrument and field names come from a small vocabulary
+            # but every record carries its own copies. Interning them means
+            # the keys in acc share one string per name.
+            event = intern(r["redcap_event_name"])
+            event_form_names = get_event_forms(event)
 
             # The API will return 1, "2", for repeat instances.
             # Note that 1 was an int and 2 was a str.
             # The API can also return "" or nothing at all.
-            instance = str(r.pop("redcap_repeat_instance", "1") or "1")
-            repeat_form = r.pop("redcap_repeat_instrument", None)
+            instance = str(r.get("redcap_repeat_instance") or "1")
+            repeat_form = r.get("redcap_repeat_instrument")
+            if repeat_form:
+                repeat_form = intern(repeat_form)
 
             if debug_type == "eav":
+                field = r["field_name"]
+                if field == record_id_field:
+                    # get_records leaves these rows out of eav exports, so
+                    # they don't count a subject as present on their own
+                    continue
+                field = intern(field)
+
                 subject = r["record"]
-                all_subjects.add(subject)
+                add_subject(subject)
 
-                field = r["field_name"]
                 value = r["value"]
-                form = repeat_form or field_forms.get(field)
-
-                _check_error_map_add()
+                form = repeat_form or get_form(field)
+
+                _check_error_map_add(
+                    event,
+                    event_form_names,
+                    subject,
+                    instance,
+                    form,
+                    field,
+                    value,
+                )
             else:
-                subject = r.pop(record_id_field)
-                all_subjects.add(subject)
+                subject = r[record_id_field]
+                add_subject(subject)
+
+                if len(r) != flat_len:
+                    flat_fields = [k for k in r if k not in not_fields]
+                    flat_len = len(r)
 
-                for field, value in r.items():
-                    form = repeat_form or field_forms.get(field)
+                for field in flat_fields:
+                    value = r[field]
+                    form = repeat_form or get_form(field)
 
-                    if re.search(r"___\d+$", field):  # probably checkboxes
-                        real_field, real_value = field.rsplit("___", 1)
+                    real_field, sep, real_value = field.rpartition("___")
+                    if sep and real_value.isdecimal():  # probably checkboxes
                         if real_field in selector_map:  # definitely checkboxes
                             if value == "0":
                                 continue  # checkbox not selected
@@ -609,22 +1090,41 @@ class REDCapStudy:
 
                             field = real_field
                             value = real_value
-                            form = field_forms.get(field)
+                            form = get_form(field)
 
                     if value == "":  # regular field not populated
                         continue
 
-                    _check_error_map_add()
+                    _check_error_map_add(
+                        event,
+                        event_form_names,
+                        subject,
+                        instance,
+                        form,
+                        field,
+                        value,
+                    )
+
+        store = {}
+        for (event, form, subject, instance, field), values in acc.items():
+            subjects = store.setdefault(event, {}).setdefault(form, {})
+            instances = subjects.setdefault(subject, {})
+            instances.setdefault(instance, {})[field] = sorted(values)
 
+        # mark unused forms/fields as present and empty (a project without
+        # subjects has nothing to mark, so it stays an empty tree)
+        if not all_subjects:
+            event_forms = {}
         for event_name, event_form_names in event_forms.items():
+            event_store = store.setdefault(event_name, {})
             for form_name in event_form_names:
-                for subject in all_subjects:
-                    if not store[event_name][form_name][subject]:
-                        store[event_name][form_name][subject] = {"1": dict()}
-                    for i, iv in store[event_name][form_name][subject].items():
-                        if f"{form_name}_complete" not in iv:
-                            store[event_name][form_name][subject][i][
-                                f"{form_name}_complete"
-                            ] = {"Incomplete"}
-
-        return _undefault_dict(store), _undefault_dict(errors)
+                form_store = event_store.setdefault(form_name, {})
+                complete = f"{form_name}_complete"
+                for instances in form_store.values():
+                    for iv in instances.values():
+                        if complete not in iv:
+                            iv[complete] = ["Incomplete"]
+                for subject in all_subjects - form_store.keys():
+                    form_store[subject] = {"1": {complete: ["Incomplete"]}}
+
+        return store, _undefault_dict(errors)
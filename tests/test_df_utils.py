@@ -0,0 +1,34 @@
+import json
+
+from pandas import DataFrame
+
+from d3b_redcap_api.df_utils import all_dfs, summary_column
+
+
+def test_summary_column():
+    df = DataFrame(
+        {"a": ["x", "", "y"], "b": ["1", "", ""], "c": ["q", "", "z"]}
+    )
+    for sep in ["|", ";", "."]:
+        sc = summary_column(df, ["a", "b", "c"], sep)
+        assert list(sc) == [f"x{sep}1{sep}q", "", f"y{sep}{sep}z"]
+
+
+def test_all_dfs():
+    with open("tests/records_tree.json") as rtjp:
+        dfs = all_dfs(json.load(rtjp))
+    assert set(dfs) == {
+        "enrollment",
+        "demographics",
+        "predispositions",
+        "diagnosis",
+        "update",
+        "treatment",
+        "specimen",
+    }
+    # instruments with nothing but a completion status have no rows
+    assert dfs["treatment"].empty
+
+    p = dfs["predispositions"].set_index("subject")
+    assert p.loc["2", "family_member"] == "Father+Paternal Grandmother"
+    assert p.loc["3", "predispositions_complete"] == "Incomplete"
@@ -0,0 +1,371 @@
+import json
+import os
+import time
+
+import numpy
+import pytest
+
+from d3b_redcap_api.redcap import REDCapError, REDCapStudy, _run_batches
+
+DATA_DICTIONARY = [
+    {"field_name": "record_id", "form_name": "enrollment", "field_type": "text"}
+]
+SUBJECTS = ["1", "2", "3", "4", "5"]
+
+
+class _Response:
+    def __init__(self, content=b"", headers=None):
+        self.status_code = 200
+        self.content = content
+        self.text = content.decode()
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def _json_response(obj):
+    return _Response(json.dumps(obj).encode())
+
+
+def _study(monkeypatch, handler, **kwargs):
+    """Make a REDCapStudy that sends its API requests to
+    handler(content, params) instead of a server.
+
+    :return: the study and the list of content types it requested
+    """
+    monkeypatch.delenv("REDCAP_CACHE", raising=False)
+    r = REDCapStudy("https://redcap.example.org/api/", "token", **kwargs)
+    calls = []
+
+    def _get_response(content, params=None, **kw):
+        calls.append(content)
+        return handler(content, params or {})
+
+    monkeypatch.setattr(r, "_get_response", _get_response)
+    return r, calls
+
+
+def test_disk_cache(monkeypatch, tmp_path):
+    def handler(content, params):
+        return _json_response(DATA_DICTIONARY)
+
+    r, calls = _study(monkeypatch, handler, cache_dir=str(tmp_path))
+    assert r.get_data_dictionary() == DATA_DICTIONARY
+    assert calls == ["metadata"]
+    assert len(os.listdir(tmp_path)) == 1
+
+    # another study for the same project reads it back without asking
+    r, calls = _study(monkeypatch, handler, cache_dir=str(tmp_path))
+    assert r.get_data_dictionary() == DATA_DICTIONARY
+    assert calls == []
+
+    # expired entries are fetched again
+    r, calls = _study(
+        monkeypatch, handler, cache_dir=str(tmp_path), cache_max_age=0
+    )
+    assert r.get_data_dictionary() == DATA_DICTIONARY
+    assert calls == ["metadata"]
+
+    r.refresh_metadata()
+    assert os.listdir(tmp_path) == []
+
+
+def test_disk_cache_corrupt_entry(monkeypatch, tmp_path):
+    def handler(content, params):
+        return _json_response(DATA_DICTIONARY)
+
+    r, calls = _study(monkeypatch, handler, cache_dir=str(tmp_path))
+    r.get_data_dictionary()
+    (path,) = tmp_path.iterdir()
+    data = bytearray(path.read_bytes())
+    # keep the gzip header but start the compressed data with a block of the
+    # reserved type, which zlib refuses
+    data[10] = 0xFF
+    path.write_bytes(bytes(data))
+
+    r, calls = _study(monkeypatch, handler, cache_dir=str(tmp_path))
+    assert r.get_data_dictionary() == DATA_DICTIONARY
+    assert calls == ["metadata"]
+
+
+def test_disk_cache_write_failure(monkeypatch, tmp_path):
+    def handler(content, params):
+        return _json_response(DATA_DICTIONARY)
+
+    def replace(src, dst):
+        raise OSError("disk full")
+
+    r, calls = _study(monkeypatch, handler, cache_dir=str(tmp_path))
+    monkeypatch.setattr(os, "replace", replace)
+    assert r.get_data_dictionary() == DATA_DICTIONARY
+    # no temporary file is left behind
+    assert os.listdir(tmp_path) == []
+
+
+def test_request_data_encoding(monkeypatch):
+    # the data payload encodes the same with or without orjson installed
+    monkeypatch.delenv("REDCAP_CACHE", raising=False)
+    r = REDCapStudy("https://redcap.example.org/api/", "token")
+    sent = {}
+
+    def post(url, data, **kwargs):
+        sent.update(data)
+        return _json_response({"count": 1})
+
+    monkeypatch.setattr(r._session, "post", post)
+    records = [
+        {"record": "1", "field_name": "age", "value": numpy.float64(2.5)}
+    ]
+    r.set_records(records)
+    assert json.loads(sent["data"]) == json.loads(json.dumps(records))
+    r.set_project_info({1: "non-str key"})
+    assert json.loads(sent["data"]) == {"1": "non-str key"}
+
+
+def _records_handler(content, params):
+    """Serve eav records for SUBJECTS, failing like an overloaded server for
+    any batch of more than two subjects."""
+    if content == "metadata":
+        return _json_response(DATA_DICTIONARY)
+    if "records" not in params:  # get_subjects
+        return _json_response([{"record_id": s} for s in SUBJECTS])
+    batch = params["records"].split(",")
+    if len(batch) > 2:
+        raise REDCapError("HTTP 500 - out of memory")
+    records = []
+    for s in batch:
+        records.append({"record": s, "field_name": "record_id", "value": s})
+        records.append({"record": s, "field_name": "age", "value": s})
+    return _json_response(records)
+
+
+def test_get_records_splits_failed_batches(monkeypatch):
+    r, calls = _study(monkeypatch, _records_handler)
+    records = r.get_records(batch_size=len(SUBJECTS))
+    # the record id rows are left out of eav exports
+    assert sorted(rec["value"] for rec in records) == SUBJECTS
+    assert all(rec["field_name"] == "age" for rec in records)
+
+
+def test_run_batches_in_flight():
+    started = []
+
+    def func(batch):
+        started.append(batch)
+        return batch
+
+    results = _run_batches(func, [[1], [2], [3], [4]], workers=2)
+    time.sleep(0.1)
+    # only the first two batches are requested until results are taken
+    assert len(started) == 2
+    taken = [next(results), next(results)]
+    time.sleep(0.1)
+    assert len(started) == 2
+    taken.extend(results)
+    assert sorted(taken) == [[1], [2], [3], [4]]
+
+
+def test_get_records_no_subjects(monkeypatch):
+    def handler(content, params):
+        if content == "metadata":
+            return _json_response(DATA_DICTIONARY)
+        return _json_response([])
+
+    r, calls = _study(monkeypatch, handler)
+    assert r.get_records() == []
+
+
+@pytest.mark.parametrize("kwargs", [{"workers": 0}, {"batch_size": 0}])
+def test_batch_arguments(monkeypatch, kwargs):
+    r, calls = _study(monkeypatch, _records_handler)
+    with pytest.raises(ValueError):
+        r.get_records(**kwargs)
+    with pytest.raises(ValueError):
+        r.set_records_batched(_eav_records(SUBJECTS), **kwargs)
+    assert calls == []
+
+
+def test_get_records_tree_no_subjects(monkeypatch):
+    def handler(content, params):
+        if content == "metadata":
+            return _json_response(DATA_DICTIONARY)
+        if content == "formEventMapping":
+            return _json_response(
+                [{"unique_event_name": "baseline_arm_1", "form": "enrollment"}]
+            )
+        return _json_response([])
+
+    r, calls = _study(monkeypatch, handler)
+    assert r.get_records_tree() == ({}, {})
+
+
+def test_get_records_tree_classic_project(monkeypatch):
+    def handler(content, params):
+        if content == "formEventMapping":
+            time.sleep(0.1)  # give records a chance to start too early
+            raise REDCapError("HTTP 400 - not a longitudinal project")
+        return _records_handler(content, params)
+
+    r, calls = _study(monkeypatch, handler)
+    with pytest.raises(REDCapError, match="not a longitudinal project"):
+        r.get_records_tree()
+    # no records were downloaded only to be thrown away
+    assert "record" not in calls
+
+
+def _import_handler(content, params):
+    """Count the subjects in each import, failing like an overloaded server
+    for more than two subjects and rejecting the subject named "bad"."""
+    subjects = {rec["record"] for rec in params["data"]}
+    if len(subjects) > 2:
+        raise REDCapError("HTTP 500 - out of memory")
+    if "bad" in subjects:
+        raise REDCapError("HTTP 400 - invalid value for subject bad")
+    return _json_response({"count": len(subjects)})
+
+
+def _eav_records(subjects):
+    return [
+        {"record": s, "field_name": f, "value": s}
+        for s in subjects
+        for f in ("record_id", "age")
+    ]
+
+
+def test_set_records_batched_counts_all_batches(monkeypatch):
+    r, calls = _study(monkeypatch, _import_handler)
+    result = r.set_records_batched(_eav_records(SUBJECTS), batch_size=2)
+    assert result == {"count": len(SUBJECTS)}
+    assert len(calls) == 3
+
+
+def test_set_records_batched_splits_failed_batches(monkeypatch):
+    r, calls = _study(monkeypatch, _import_handler)
+    result = r.set_records_batched(_eav_records(SUBJECTS), batch_size=5)
+    assert result == {"count": len(SUBJECTS)}
+
+
+def test_set_records_batched_bad_subject(monkeypatch):
+    r, calls = _study(monkeypatch, _import_handler)
+    with pytest.raises(REDCapError, match="subject bad"):
+        r.set_records_batched(_eav_records(["1", "bad"]), batch_size=5)
+
+
+def test_set_records_batched_request_error(monkeypatch):
+    # an error that every subject gets isn't narrowed down subject by subject
+    def handler(content, params):
+        raise REDCapError("HTTP 400 - unknown field")
+
+    r, calls = _study(monkeypatch, handler)
+    with pytest.raises(REDCapError, match="unknown field"):
+        r.set_records_batched(_eav_records(SUBJECTS * 4), batch_size=20)
+    assert len(calls) == 3
+
+
+def test_set_records_batched_waits_before_raising(monkeypatch):
+    started = []
+    finished = []
+
+    def handler(content, params):
+        subjects = {rec["record"] for rec in params["data"]}
+        started.append(subjects)
+        if "bad" in subjects:
+            raise REDCapError("HTTP 400 - invalid value for subject bad")
+        time.sleep(0.1)
+        finished.append(subjects)
+        return _json_response({"count": len(subjects)})
+
+    r, calls = _study(monkeypatch, handler)
+    records = _eav_records(["bad", "1", "2", "3", "4", "5", "6"])
+    with pytest.raises(REDCapError, match="subject bad"):
+        r.set_records_batched(records, batch_size=1, workers=4)
+    # nothing is still being imported once the error reaches the caller
+    assert len(finished) == len(started) - 1
+
+
+@pytest.mark.parametrize(
+    "content_type,file_name",
+    [
+        # non-ASCII characters percent-encoded as UTF-8
+        (
+            'application/pdf; name="r%C3%A9sum%C3%A9.pdf";charset=UTF-8',
+            "résumé.pdf",
+        ),
+        # raw UTF-8 bytes, which arrive decoded as latin-1
+        (
+            'application/pdf; name="'
+            + "résumé.pdf".encode().decode("latin1")
+            + '";charset=UTF-8',
+            "résumé.pdf",
+        ),
+        # name is the last parameter
+        ('application/pdf; name="plain.pdf"', "plain.pdf"),
+    ],
+)
+def test_get_file_name(monkeypatch, content_type, file_name):
+    def handler(content, params):
+        return _Response(b"%PDF", {"Content-Type": content_type})
+
+    r, calls = _study(monkeypatch, handler)
+    assert r.get_file("1", "consent") == {
+        "body": b"%PDF",
+        "filename": file_name,
+    }
+
+
+def test_get_file_stream(monkeypatch):
+    body = b"%PDF" * 50000
+    sent = {}
+
+    def _get_response(content, params=None, **kwargs):
+        sent.update(kwargs)
+        return _Response(
+            body, {"Content-Type": 'application/pdf; name="a.pdf"'}
+        )
+
+    r, calls = _study(monkeypatch, None)
+    monkeypatch.setattr(r, "_get_response", _get_response)
+    f = r.get_file("1", "consent", stream=True)
+    assert sent["stream"] is True
+    assert f["filename"] == "a.pdf"
+    # the body comes in chunks rather than as one bytes object
+    chunks = list(f["body"])
+    assert len(chunks) > 1
+    assert b"".join(chunks) == body
+
+
+def test_get_project_xml_to_file(monkeypatch, tmp_path):
+    xml = b"<?xml version='1.0'?><ODM>" + b"<Study/>" * 20000 + b"</ODM>"
+    sent = {}
+
+    def _get_response(content, params=None, **kwargs):
+        sent.update(kwargs)
+        return _Response(xml)
+
+    r, calls = _study(monkeypatch, None)
+    monkeypatch.setattr(r, "_get_response", _get_response)
+    path = tmp_path / "project.xml"
+    r.get_project_xml_to_file(str(path))
+    assert sent["stream"] is True
+    assert path.read_bytes() == xml
+
+
+def test_get_project_xml_to_file_interrupted(monkeypatch, tmp_path):
+    class _BrokenResponse(_Response):
+        def iter_content(self, chunk_size=1):
+            yield b"<?xml version='1.0'?><ODM>"
+            raise ConnectionError("connection reset")
+
+    r, calls = _study(monkeypatch, lambda content, params: _BrokenResponse())
+    path = tmp_path / "project.xml"
+    with pytest.raises(ConnectionError):
+        r.get_project_xml_to_file(str(path))
+    assert not path.exists()